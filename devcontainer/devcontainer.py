@@ -16,48 +16,436 @@ This assumes you are running Docker.
 
 import argparse
 import os
-import jstyleson
+import json
 import subprocess
 import sys
-import hashlib
 import re
-import signal
-import asyncio
-
-container_name = ''
-
-
+import functools
+import posixpath
+import time
+
+# hashlib, jstyleson and tempfile are imported where they are used, so early
+# exits such as --help do not pay for loading them.
+
+_ENV_RE = re.compile(r"\{([^}]*)\}")
+# Environment read by substitute_env; frozen by snapshot_env.
+_environ = os.environ
+
+CACHE_DIR = os.path.expanduser('~/.cache/devcontainer/')
+# Cache entries that have not been used in this many days are removed.
+CACHE_MAX_AGE_DAYS = 30
+
+
+def prune_cache(max_age_days=CACHE_MAX_AGE_DAYS):
+    '''Remove cache entries older than max_age_days.'''
+    cutoff = time.time() - max_age_days * 86400
+    try:
+        entries = list(os.scandir(CACHE_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.name.endswith(('.json', '.tag')) and \
+               entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def cache_file(path, suffix):
+    '''Return the file in CACHE_DIR that caches data derived from path.'''
+    import hashlib
+
+    name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(CACHE_DIR, f'{name}{suffix}')
+
+
+def write_cache(filename, text):
+    '''Write text to filename atomically, ignoring errors.
+
+    A concurrent run never sees a partial file.
+    '''
+    import tempfile
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    except OSError:
+        pass
+
+
+def touch_cache(filename):
+    '''Mark a cache entry as used, so prune_cache keeps it.'''
+    try:
+        os.utime(filename)
+    except OSError:
+        pass
+
+
+def load_devcontainer_cached(path):
+    '''Load the devcontainer.json at path, using a cache when possible.
+
+    devcontainer.json is usually not valid json; it has comments and allows
+    trailing commas. jstyleson is able to handle these, but it is slow, so the
+    parsed result is cached as plain json in CACHE_DIR, keyed on the mtime and
+    size of path.
+    '''
+    st = os.stat(path)
+    key = [st.st_mtime_ns, st.st_size]
+    cached_json = cache_file(path, '.json')
+
+    try:
+        with open(cached_json) as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            data = cached['data']
+            touch_cache(cached_json)
+            return data
+    except (OSError, ValueError, AttributeError, KeyError, TypeError):
+        # A missing or malformed entry is a miss, and is rewritten below
+        pass
+
+    import jstyleson
+
+    with open(path) as f:
+        data = jstyleson.loads(f.read())
+
+    write_cache(cached_json, json.dumps({'key': key, 'data': data}))
+    prune_cache()
+    return data
+
+
+def file_hash(path):
+    '''Return a 32 character BLAKE2b hex digest of the file at path.
+
+    The file is streamed in 64 KiB chunks rather than read into memory.
+    '''
+    import hashlib
+
+    with open(path, 'rb') as fh:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(
+                fh, lambda: hashlib.blake2b(digest_size=16)).hexdigest()
+        h = hashlib.blake2b(digest_size=16)
+        while chunk := fh.read(65536):
+            h.update(chunk)
+        return h.hexdigest()
+
+
+def dockerfile_info(path, reads_context=None):
+    '''Return (file_hash(path), needs_context(...)) for the Dockerfile at path.
+
+    Both are stored in CACHE_DIR next to the mtime and size of path, so an
+    unchanged Dockerfile is only stat'ed instead of read and parsed again.
+    Pass reads_context to record it instead of deriving it from the
+    Dockerfile, e.g. once a build without the context has failed.
+    '''
+    st = os.stat(path)
+    key = f'{st.st_mtime_ns} {st.st_size}'
+    cached_tag = cache_file(path, '.tag')
+
+    if reads_context is None:
+        try:
+            with open(cached_tag) as f:
+                mtime_ns, size, digest, cached = f.read().split()
+            if f'{mtime_ns} {size}' == key:
+                touch_cache(cached_tag)
+                return digest, cached == '1'
+        except (OSError, ValueError):
+            pass
+
+    digest = file_hash(path)
+    if reads_context is None:
+        with open(path, 'rb') as f:
+            reads_context = needs_context(f.read().decode(errors='replace'))
+    write_cache(cached_tag, f'{key} {digest} {int(reads_context)}\n')
+    return digest, reads_context
+
+
+def read_dockerignore(context):
+    '''Return (negate, pattern) pairs from the .dockerignore file of context.'''
+    try:
+        with open(os.path.join(context, '.dockerignore')) as f:
+            lines = [line.strip() for line in f]
+    except FileNotFoundError:
+        return []
+    patterns = []
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        # Like docker, patterns are cleaned and relative to the context root
+        pattern = posixpath.normpath(line.lstrip('!').strip().lstrip('/'))
+        if pattern != '.':
+            patterns.append((negate, pattern))
+    return patterns
+
+
+@functools.lru_cache(maxsize=None)
+def pattern_regex(pattern):
+    '''Compile a .dockerignore pattern the way docker matches it.
+
+    * and ? do not match /, while ** matches any number of directories.
+    '''
+    parts = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif c == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif c == '?':
+            parts.append('[^/]')
+            i += 1
+        elif c == '[' and (end := pattern.find(']', i + 2)) > 0:
+            body = pattern[i + 1:end]
+            if body[0] in '!^':
+                body = '^' + body[1:]
+            parts.append(f'[{body.replace(chr(92), chr(92) * 2)}]')
+            i = end + 1
+        elif c == '\\' and i + 1 < len(pattern):
+            parts.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            parts.append(re.escape(c))
+            i += 1
+    return re.compile(''.join(parts) + '$')
+
+
+def is_ignored(relpath, patterns):
+    '''Return True if relpath is excluded by the .dockerignore patterns.
+
+    As in docker, a pattern also excludes everything below a directory it
+    matches, later patterns win, and a negated pattern re-includes a path.
+
+    >>> is_ignored('sub/x.md', [(False, '*.md')])
+    False
+    >>> is_ignored('sub/x.md', [(False, '**/*.md')])
+    True
+    >>> is_ignored('dir/keep', [(False, 'dir'), (True, 'dir/keep')])
+    False
+    '''
+    segments = relpath.split('/')
+    paths = ['/'.join(segments[:i]) for i in range(1, len(segments) + 1)]
+    ignored = False
+    for negate, pattern in patterns:
+        regex = pattern_regex(pattern)
+        if any(regex.match(path) for path in paths):
+            ignored = not negate
+    return ignored
+
+
+def may_reinclude(relpath, patterns):
+    '''Return True if a negated pattern could match something below relpath.'''
+    segments = relpath.split('/')
+    for negate, pattern in patterns:
+        if not negate:
+            continue
+        psegments = pattern.split('/')
+        for segment, psegment in zip(segments, psegments):
+            if '**' in psegment:
+                return True
+            if not pattern_regex(psegment).match(segment):
+                break
+        else:
+            if len(psegments) > len(segments):
+                return True
+    return False
+
+
+def context_files(context, patterns, prefix=''):
+    '''Yield (relpath, size, mtime_ns) for files in context not ignored.'''
+    with os.scandir(os.path.join(context, prefix)) as it:
+        entries = sorted(it, key=lambda e: e.name)
+    for entry in entries:
+        relpath = f'{prefix}{entry.name}'
+        if entry.is_dir(follow_symlinks=False):
+            # An ignored directory is only skipped when nothing inside it
+            # can be re-included by a later ! pattern.
+            if not is_ignored(relpath, patterns) or \
+               may_reinclude(relpath, patterns):
+                yield from context_files(context, patterns, f'{relpath}/')
+        elif not is_ignored(relpath, patterns):
+            # docker sends symlinks as links, so a dangling one is fine
+            st = entry.stat(follow_symlinks=False)
+            yield relpath, st.st_size, st.st_mtime_ns
+
+
+def image_tag(digest, build_args, context=None):
+    '''Return a tag identifying the image built from a Dockerfile.
+
+    digest is the file_hash of the Dockerfile, which covers its FROM lines.
+    The tag also covers the build args and, when the build sends a context,
+    the size and mtime of every file in it that is not excluded by
+    .dockerignore, so a change to any of them gives a new tag instead of
+    reusing a stale image. Without a context, edits to devcontainer.json or
+    other files in .devcontainer do not change the tag.
+    '''
+    import hashlib
+
+    h = hashlib.blake2b(digest_size=16)
+    h.update(digest.encode())
+    for key, val in sorted(build_args.items()):
+        h.update(f'\0arg\0{key}={val}'.encode())
+    if context is not None:
+        patterns = read_dockerignore(context)
+        for relpath, size, mtime_ns in context_files(context, patterns):
+            h.update(f'\0file\0{relpath}\0{size}\0{mtime_ns}'.encode())
+    return h.hexdigest()
+
+
+def dockerfile_instructions(dockerfile):
+    '''Yield (INSTRUCTION, arguments) for each instruction in dockerfile.
+
+    Lines continued with a trailing backslash are joined, and comments and
+    blank lines inside a continuation are dropped, as docker does.
+    '''
+    current = ''
+    for line in dockerfile.splitlines():
+        stripped = line.strip()
+        if stripped.startswith('#') or (not stripped and current):
+            continue
+        if stripped.endswith('\\'):
+            current += stripped[:-1] + ' '
+            continue
+        current += stripped
+        if words := current.split(None, 1):
+            yield words[0].upper(), words[1] if len(words) > 1 else ''
+        current = ''
+    if words := current.split(None, 1):
+        yield words[0].upper(), words[1] if len(words) > 1 else ''
+
+
+def copy_arguments(arguments):
+    '''Split the arguments of a COPY or ADD into (flags, paths).
+
+    Raises ValueError if a JSON form argument list cannot be parsed.
+    '''
+    flags = []
+    rest = arguments.strip()
+    while rest.startswith('--'):
+        flag, _, rest = rest.partition(' ')
+        flags.append(flag)
+        rest = rest.strip()
+    if rest.startswith('['):
+        return flags, json.loads(rest)
+    return flags, rest.split()
+
+
+def copy_sources(dockerfile):
+    r'''Return the local sources of the COPY and ADD lines in dockerfile.
+
+    dockerfile is the text of the Dockerfile. Sources copied from another
+    stage or image (--from) and remote URLs do not come from the build
+    context, so they are left out.
+
+    >>> copy_sources('FROM x\nCOPY --chown=a:b \\\n    req.txt /tmp/\n')
+    ['req.txt']
+    >>> copy_sources('FROM x\nCOPY \\\n  # comment\n  a.txt b.txt /tmp/\n')
+    ['a.txt', 'b.txt']
+    >>> copy_sources('FROM x\nADD ["a b", "https://x/y", "/c/"]\n')
+    ['a b']
+    >>> copy_sources('FROM x\nCOPY --from=build /app /app\n')
+    []
+    '''
+    sources = []
+    for instruction, arguments in dockerfile_instructions(dockerfile):
+        if instruction not in ('COPY', 'ADD'):
+            continue
+        try:
+            flags, paths = copy_arguments(arguments)
+        except ValueError:
+            continue
+        if any(flag.startswith('--from') for flag in flags):
+            continue
+        sources += [path for path in paths[:-1] if '://' not in path]
+    return sources
+
+
+def needs_context(dockerfile):
+    r'''Return True unless dockerfile itself does not read the build context.
+
+    Only a Dockerfile whose COPY and ADD instructions all use --from, and
+    which has no --mount and no parser directive changing the escape
+    character, is expected to build without the context. ONBUILD triggers
+    in the base image are not visible here, so a False result can still be
+    wrong; the caller retries with the context when that build fails.
+
+    >>> needs_context('FROM x\nRUN true\n')
+    False
+    >>> needs_context('FROM x\nCOPY --from=build /app /app\n')
+    False
+    >>> needs_context('FROM x\nCOPY \\\n  a.txt /tmp/\n')
+    True
+    >>> needs_context('FROM x\nRUN --mount=type=bind,source=a,target=/a true\n')
+    True
+    '''
+    if '--mount' in dockerfile or re.search(r'^\s*#\s*escape\s*=', dockerfile,
+                                            re.IGNORECASE | re.MULTILINE):
+        return True
+    for instruction, arguments in dockerfile_instructions(dockerfile):
+        if instruction not in ('COPY', 'ADD'):
+            continue
+        try:
+            flags, _ = copy_arguments(arguments)
+        except ValueError:
+            return True
+        if not any(flag.startswith('--from') for flag in flags):
+            return True
+    return False
+
+
+def image_exists(tag):
+    '''Return True if an image named tag exists in the local docker daemon.'''
+    # Only the image id is formatted, instead of the full JSON description.
+    return subprocess.run(['docker', 'image', 'inspect', '--format={{.Id}}', tag],
+                          stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL).returncode == 0
+
+
+def snapshot_env():
+    '''Freeze the environment used by substitute_env and return it.'''
+    global _environ
+    _environ = dict(os.environ)
+    substitute_env.cache_clear()
+    return _environ
+
+
+@functools.lru_cache(maxsize=256)
 def substitute_env(val):
+    # Most values have no variables at all
+    if "{" not in val:
+        return val
     # Format variables
     val = val.replace("${localEnv:", "{")
-    # Replace defined variables
-    for key, value in dict(os.environ).items():
-        if val.find("{"+key+"}") >= 0:
-            val = val.replace("{"+key+"}", value)
-    # Remove undefined variables
-    val = re.sub(r"\{[^}]*\}", "", val)
-    return val
-
-
-def stop():
-    global container_name
-    print("stopping")
-    subprocess.Popen(['docker', 'container', 'kill', f'{container_name}'])
+    # Replace defined variables and remove undefined ones in one pass
+    return _ENV_RE.sub(lambda m: _environ.get(m.group(1), ""), val)
 
 
 def devcontainer():
-    asyncio.run(main())
-
-
-async def main():
-    global container_name
     '''Launch the devcontainer in current directory.'''
+    parser = argparse.ArgumentParser(description='devcontainer')
+    parser.add_argument('entrypoint', nargs='?',
+                        help='Optional entrypoint')
 
-    pid = os.getpid()
+    args = parser.parse_args()
 
-    signal.signal(signal.SIGINT, lambda signal, frame: stop())
-    signal.signal(signal.SIGTERM, lambda signal, frame: stop())
-    signal.signal(signal.SIGQUIT, lambda signal, frame: stop())
+    pid = os.getpid()
+    # Snapshot the environment once for all substitutions
+    environ = snapshot_env()
 
     if not os.path.isdir('.devcontainer'):
         raise Exception('No .devcontainer found')
@@ -66,91 +454,233 @@ async def main():
         raise Exception('No .devcontainer/devcontainer.json found')
 
     # Load the json file
-    with open('.devcontainer/devcontainer.json') as f:
-        # devcontainer.json is usually not valid json; it has comments and
-        # allows trailing commas. jstyleson is able to handle these, so we use
-        # it here.
-        devcontainer = jstyleson.loads(f.read())
-
-    parser = argparse.ArgumentParser(description='devcontainer')
-    parser.add_argument('entrypoint', nargs='?',
-                        help='Optional entrypoint')
-
-    args = parser.parse_args()
+    devcontainer = load_devcontainer_cached('.devcontainer/devcontainer.json')
+
+    # Look up every setting we use once
+    get = devcontainer.get
+    remote_user = get('remoteUser')
+    ports_cfg = get('forwardPorts', ())
+    env_cfg = get('containerEnv', {})
+    work_folder = get('workspaceFolder')
+    mount_cfg = get('workspaceMount')
+    # This is a path relative to .devcontainer I think.
+    DOCKERFILE = get('dockerFile')
+    DOCKERIMAGE = get('image')
+    build_cfg = get('build', {})
+    build_args = build_cfg.get('args', {})
+    cache_from = build_cfg.get('cacheFrom', [])
+    run_args_cfg = get('runArgs', ())
 
-    if REMOTE_USER := devcontainer.get('remoteUser', []):
-        REMOTE_USER = ['-u', REMOTE_USER]
+    REMOTE_USER = ['-u', remote_user] if remote_user else []
 
-    PORTS = []
-    for port in devcontainer.get('forwardPorts', []):
-        PORTS += ['-p']
-        PORTS += [f'{port}:{port}']
+    PORTS = [x for port in ports_cfg for x in ('-p', f'{port}:{port}')]
 
-    ENVS = []
-    for key, val in devcontainer.get('containerEnv', {}).items():
-        ENVS += ['-e']
-        ENVS += [f'{key}={substitute_env(val)}']
+    ENVS = [x for key, val in env_cfg.items()
+            for x in ('-e', f'{key}={substitute_env(val)}')]
 
     ENTRYPOINT = args.entrypoint or '/bin/bash'
 
     # local directory
     WORKSPACE = os.getcwd()
+    BASENAME = os.path.basename(WORKSPACE)
     # where to mount it remotely
-    WORK_DIR = devcontainer.get(
-        'workspaceFolder', f'/{os.path.split(WORKSPACE)[-1]}')
+    WORK_DIR = work_folder or f'/{BASENAME}'
 
-    if ws := devcontainer.get('workspaceMount', None):
-        ws = ws.replace('${localWorkspaceFolder}', WORKSPACE)
-        MOUNT = ['--mount', ws]
+    if mount_cfg:
+        MOUNT = ['--mount', mount_cfg.replace('${localWorkspaceFolder}', WORKSPACE)]
     else:
         MOUNT = ['--mount', f'type=bind,source={WORKSPACE},target={WORK_DIR}']
 
-    # This is a path relative to .devcontainer I think.
-    DOCKERFILE = devcontainer.get('dockerFile', None)
-
-    if DOCKERFILE is None:
-        DOCKERIMAGE = devcontainer.get('image', None)
+    BUILD_ARGS = [x for key, val in build_args.items()
+                  for x in ('--build-arg', f'{key}={val}')]
 
-    ARGS = ' '.join([f'--build-arg {key}="{val}"' for key,
-                    val in devcontainer.get('build', {}).get('args', {}).items()])
+    # Images to reuse layers from, e.g. one pushed to a registry. BuildKit
+    # fetches their cache metadata and only the layers it reuses.
+    if isinstance(cache_from, str):
+        cache_from = [cache_from]
+    CACHE_FROM = [f'--cache-from={image}' for image in cache_from]
 
-    run_args = devcontainer.get('runArgs', [])
-    for i in range(len(run_args)):
-        if run_args[i].find(" ") >= 0:
-            run_args[i-1] = f"{run_args[i-1]}={run_args[i]}"
-            run_args[i] = ""
+    # Values with spaces are joined to the preceding option with "="
+    merged = []
+    for tok in run_args_cfg:
+        if " " in tok and merged:
+            merged[-1] = f"{merged[-1]}={tok}"
+        else:
+            merged.append(tok)
 
     # Substitute env vars
-    for i in range(len(run_args)):
-        run_args[i] = substitute_env(run_args[i])
-
-    RUNARGS = run_args
-    container_name = f"devcontainer-{pid}"
+    RUNARGS = [arg for arg in (substitute_env(tok) for tok in merged)
+               if arg]
+    # docker only allows [a-zA-Z0-9_.-] in container names
+    container_name = f"devcontainer-{re.sub(r'[^a-zA-Z0-9_.-]', '-', BASENAME)}-{pid}"
 
     if DOCKERFILE:
-        # Build it. we use the md5 hash of the dockerfile as a name.
-        TAG = hashlib.md5(
-            open(f'.devcontainer/{DOCKERFILE}', 'rb').read()).hexdigest()
-        subprocess.check_output(f'docker build -t {TAG} -f .devcontainer/{DOCKERFILE} {ARGS} .devcontainer',
-                                shell=True, stderr=subprocess.PIPE)
-        # filter out empty strings
-        cmd = [arg for arg in ['/usr/bin/docker', 'docker', 'run', '-it', '--rm', "--pid=host", "--stop-signal=SIGKILL", '--name', container_name,
-                               *REMOTE_USER, *PORTS, *ENVS, *RUNARGS, *MOUNT, '-w', WORK_DIR,
-                               TAG, f"/bin/bash", "-i", "-c", f"source ~/.bashrc;{ENTRYPOINT}"] if arg]
+        # Build it. we use a hash of the dockerfile, build args and build
+        # context (when the dockerfile reads it) as a name.
+        DOCKERFILE_PATH = f'.devcontainer/{DOCKERFILE}'
+        digest, USE_CONTEXT = dockerfile_info(DOCKERFILE_PATH)
+        TAG = image_tag(digest, build_args,
+                        '.devcontainer' if USE_CONTEXT else None)
+        if not image_exists(TAG):
+            # BuildKit runs independent stages in parallel and only sends the
+            # parts of the context that changed. An explicit DOCKER_BUILDKIT
+            # in the environment wins.
+            env = {'DOCKER_BUILDKIT': '1', **environ}
+            # BUILDKIT_INLINE_CACHE embeds cache metadata in the image, so it
+            # can be used with --cache-from once pushed.
+            build = ['docker', 'build', '--progress=plain', *BUILD_ARGS,
+                     '--build-arg', 'BUILDKIT_INLINE_CACHE=1', *CACHE_FROM]
+            with open(DOCKERFILE_PATH, 'rb') as f:
+                dockerfile = f.read()
+            if not USE_CONTEXT:
+                # Nothing is read from the context, so send only the
+                # Dockerfile on stdin and no build context at all. An ONBUILD
+                # COPY in the base image still needs the context, which makes
+                # this build fail; then remember that the Dockerfile reads the
+                # context, so the tag covers it, and build again with it.
+                if subprocess.run([*build, '-t', TAG, '-'], input=dockerfile,
+                                  env=env).returncode != 0:
+                    print('Building without a context failed, retrying with '
+                          '.devcontainer', file=sys.stderr)
+                    USE_CONTEXT = True
+                    dockerfile_info(DOCKERFILE_PATH, reads_context=True)
+                    TAG = image_tag(digest, build_args, '.devcontainer')
+            if USE_CONTEXT:
+                # Absolute sources are relative to the context root.
+                text = dockerfile.decode(errors='replace')
+                outside = [src for src in copy_sources(text)
+                           if '..' in src.split('/')]
+                if outside:
+                    print(f'Warning: {", ".join(outside)} is outside the '
+                          'build context .devcontainer', file=sys.stderr)
+                subprocess.check_call([*build, '-t', TAG, '-f', DOCKERFILE_PATH,
+                                       '.devcontainer'], env=env)
+        cmd = ['docker', 'run', '-it', '--rm', "--pid=host", "--stop-signal=SIGKILL", '--name', container_name,
+               *REMOTE_USER, *PORTS, *ENVS, *RUNARGS, *MOUNT, '-w', WORK_DIR,
+               TAG, "/bin/bash", "-i", "-c", f"source ~/.bashrc;{ENTRYPOINT}"]
 
         print(
-            f'Mounting local {WORKSPACE} in {WORK_DIR} in "{container_name}"')
-        process = await asyncio.create_subprocess_exec(cmd[1], *cmd[2:])
-        await process.wait()
+            f'Mounting local {WORKSPACE} in {WORK_DIR} in "{container_name}"',
+            flush=True)
+        # Replace this process with docker, which then receives signals
+        # directly.
+        os.execvp(cmd[0], cmd)
 
     elif DOCKERIMAGE:
-        cmd = [arg for arg in ['/usr/bin/docker', 'docker', 'run', '-it', '--rm', "--pid=host", "--stop-signal=SIGTERM", '--name', container_name,
-                               *REMOTE_USER, *PORTS, *ENVS, *RUNARGS, *MOUNT, '-w', WORK_DIR,
-                               DOCKERIMAGE, "/bin/bash", "-i", "-c", f"source ~/.bashrc;{ENTRYPOINT}"] if arg]
+        cmd = ['docker', 'run', '-it', '--rm', "--pid=host", "--stop-signal=SIGTERM", '--name', container_name,
+               *REMOTE_USER, *PORTS, *ENVS, *RUNARGS, *MOUNT, '-w', WORK_DIR,
+               DOCKERIMAGE, "/bin/bash", "-i", "-c", f"source ~/.bashrc;{ENTRYPOINT}"]
         print(
-            f'Mounting local {WORKSPACE} in {WORK_DIR} in "{container_name}"')
-        process = await asyncio.create_subprocess_exec(cmd[1], *cmd[2:])
-        await process.wait()
+            f'Mounting local {WORKSPACE} in {WORK_DIR} in "{container_name}"',
+            flush=True)
+        # Replace this process with docker, which then receives signals
+        # directly.
+        os.execvp(cmd[0], cmd)
 
     else:
         raise Exception('No Docker image or file found.')
+
+
+# Checks for the caches that decide whether a stale image is reused. They run
+# with the docstring examples: python -m doctest devcontainer/devcontainer.py
+__test__ = {'caches': r'''
+>>> import shutil, tempfile
+>>> module = sys.modules[image_tag.__module__]
+>>> saved_cache_dir = module.CACHE_DIR
+>>> tmp = tempfile.mkdtemp()
+>>> module.CACHE_DIR = os.path.join(tmp, 'cache')
+>>> ctx = os.path.join(tmp, 'ctx')
+>>> os.makedirs(os.path.join(ctx, 'sub'))
+>>> def write(name, text, mtime_ns=10**18):
+...     path = os.path.join(ctx, name)
+...     with open(path, 'w') as f:
+...         f.write(text)
+...     os.utime(path, ns=(mtime_ns, mtime_ns))
+>>> def tag(build_args={}):
+...     digest, reads_context = dockerfile_info(os.path.join(ctx, 'Dockerfile'))
+...     return image_tag(digest, build_args, ctx if reads_context else None)
+
+The tag changes with the build args and with files that are not ignored,
+but not with ignored ones.
+
+>>> write('Dockerfile', 'FROM x\nCOPY . /src\n')
+>>> write('.dockerignore', '*.md\n')
+>>> write('a.txt', 'a')
+>>> write('b.md', 'b')
+>>> write('sub/c.md', 'c')
+>>> base = tag()
+>>> tag({'V': '1'}) != base
+True
+>>> write('a.txt', 'a', mtime_ns=2 * 10**18)
+>>> tag() != base
+True
+>>> base = tag()
+>>> write('b.md', 'bb')
+>>> tag() == base
+True
+>>> write('sub/c.md', 'cc')
+>>> tag() != base
+True
+
+A dangling symlink is part of the context, and does not break the tag.
+
+>>> base = tag()
+>>> os.symlink(os.path.join(tmp, 'missing'), os.path.join(ctx, 'dangling'))
+>>> tag() != base
+True
+
+When the Dockerfile does not read the context, its files do not matter.
+
+>>> write('Dockerfile', 'FROM x\nRUN true\n')
+>>> base = tag()
+>>> write('a.txt', 'aaa')
+>>> tag() == base
+True
+
+Once a build without the context has failed, e.g. because of an ONBUILD COPY
+in the base image, the recorded verdict brings the context back into the tag.
+
+>>> _ = dockerfile_info(os.path.join(ctx, 'Dockerfile'), reads_context=True)
+>>> tag() != base
+True
+>>> dockerfile_info(os.path.join(ctx, 'Dockerfile'))[1]
+True
+
+The Dockerfile digest is cached on its mtime and size.
+
+>>> dockerfile = os.path.join(ctx, 'Dockerfile')
+>>> digest, _ = dockerfile_info(dockerfile)
+>>> write('Dockerfile', 'FROM y\nRUN true\n')
+>>> dockerfile_info(dockerfile)[0] == digest
+True
+>>> write('Dockerfile', 'FROM y\nRUN true\n', mtime_ns=2 * 10**18)
+>>> dockerfile_info(dockerfile)[0] == file_hash(dockerfile) != digest
+True
+>>> write('Dockerfile', 'FROM yy\nRUN true\n', mtime_ns=2 * 10**18)
+>>> dockerfile_info(dockerfile)[0] == file_hash(dockerfile)
+True
+
+So is the parsed devcontainer.json, and a malformed entry is a miss.
+
+>>> config = os.path.join(ctx, 'devcontainer.json')
+>>> write('devcontainer.json', '{"image": "a" // comment\n}')
+>>> load_devcontainer_cached(config)
+{'image': 'a'}
+>>> write('devcontainer.json', '{"image": "b" // comment\n}')
+>>> load_devcontainer_cached(config)
+{'image': 'a'}
+>>> write('devcontainer.json', '{"image": "b" // comment\n}', mtime_ns=2 * 10**18)
+>>> load_devcontainer_cached(config)
+{'image': 'b'}
+>>> write('devcontainer.json', '{"image": "cc" // comment\n}', mtime_ns=2 * 10**18)
+>>> load_devcontainer_cached(config)
+{'image': 'cc'}
+>>> st = os.stat(config)
+>>> with open(cache_file(config, '.json'), 'w') as f:
+...     _ = f.write(json.dumps({'key': [st.st_mtime_ns, st.st_size]}))
+>>> load_devcontainer_cached(config)
+{'image': 'cc'}
+
+>>> module.CACHE_DIR = saved_cache_dir
+>>> shutil.rmtree(tmp)
+'''}